@@ -1,35 +1,116 @@
 #!/usr/bin/env python3
 
 """Common testing utilities."""
-import hashlib
 import io
+import hashlib
+import os
+import sys
 import json
+import venv
 import shutil
 import socket
 import platform
 import threading
+import tempfile
 import subprocess
 import unittest.mock
+import importlib.metadata
 from tempfile import TemporaryDirectory
 from pathlib import Path
 from http import HTTPStatus
 from http.server import SimpleHTTPRequestHandler
+from http.server import HTTPServer
 from http.server import ThreadingHTTPServer
 # noinspection PyUnresolvedReferences,PyProtectedMember
 from http.server import _get_best_family
 from contextlib import AbstractContextManager
+from contextlib import contextmanager
+from functools import lru_cache
 from functools import partial
-from typing import Optional, List, Tuple, Any, NamedTuple, Dict
+from typing import Optional, List, Tuple, Any, NamedTuple, Dict, Sequence, Iterator
 from shypip import Pathish
 import logging
 
 
 _log = logging.getLogger(__name__)
+ENV_TEST_TMPDIR = "SHYPIP_TEST_TMPDIR"
+# captured at import, before ram_backed_tempdir() can redirect the tempfile module
+_SYSTEM_TEMPDIR = tempfile.gettempdir()
+
+
+class ServedDirectory(NamedTuple):
+    """Directory served by an HTTP server, with the listings generated from it so far."""
+
+    path: str
+    listing_cache: Dict[str, bytes]
+
+    @staticmethod
+    def of(directory: Pathish) -> 'ServedDirectory':
+        return ServedDirectory(str(directory), {})
 
 
 class QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
 
+    # keep-alive requires a Content-Length on every response; see end_headers()
+    protocol_version = "HTTP/1.1"
     quiet_codes = {HTTPStatus.NOT_FOUND}
+    listing_cache: Optional[Dict[str, bytes]] = None
+    _response_code: Optional[int] = None
+    _content_length_sent = False
+
+    def send_response_only(self, code, message=None):
+        self._response_code = code
+        self._content_length_sent = False
+        super().send_response_only(code, message)
+
+    def send_header(self, keyword: str, value: str):
+        if keyword.lower() == "content-length":
+            self._content_length_sent = True
+        super().send_header(keyword, value)
+
+    def end_headers(self):
+        """Finish the headers, making sure the client can tell where the response ends.
+
+        Before Python 3.9, the redirect from a directory path without a trailing
+        slash had no Content-Length, so a kept-alive client would wait for a body
+        that never comes. That redirect has no body, so it gets a length of zero;
+        any other response without a length closes the connection.
+        """
+        if not self._content_length_sent and (self._response_code or 0) >= 200:
+            if self._response_code == HTTPStatus.MOVED_PERMANENTLY:
+                self.send_header("Content-Length", "0")
+            else:
+                self.send_header("Connection", "close")
+        super().end_headers()
+
+    def parse_request(self) -> bool:
+        # a handler serves every request on a kept-alive connection, so the server's
+        # current directory is looked up once each request has been received
+        served_directory: Optional[ServedDirectory] = getattr(self.server, "served_directory", None)
+        if served_directory is not None:
+            self.directory, self.listing_cache = served_directory
+        return super().parse_request()
+
+    def list_directory(self, path: str):
+        """Serve a directory listing, reusing the listing cached for the path if there is one.
+
+        The repository tree does not change while it is served, so each listing
+        only needs to be generated once.
+        """
+        cache = self.listing_cache
+        if cache is None:
+            return super().list_directory(path)
+        encoded = cache.get(path)
+        if encoded is None:
+            f = super().list_directory(path)
+            if f is not None:
+                cache[path] = f.getvalue()
+            return f
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-type", f"text/html; charset={sys.getfilesystemencoding()}")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        return io.BytesIO(encoded)
 
     def log_request(self, code='-', size='-'):
         if isinstance(code, HTTPStatus):
@@ -51,17 +132,23 @@ class QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
 # noinspection PyPep8Naming
 def build_http_server(directory: Pathish,
          ServerClass=ThreadingHTTPServer,
-         protocol="HTTP/1.0", port=8000, bind=None) -> ThreadingHTTPServer:
+         protocol="HTTP/1.1", port=8000, bind=None) -> HTTPServer:
     """Test the HTTP request handler class.
 
     This runs an HTTP server on port 8000 (or the port argument).
+    By default, connections are kept alive, so a client such as pip can
+    reuse one connection for many requests; each connection is handled
+    on its own daemon thread, so an idle kept-alive connection does not
+    block other clients.
 
     """
-    handler_class = partial(QuietHTTPRequestHandler, directory=str(directory))
+    handler_class = QuietHTTPRequestHandler
+    if protocol != handler_class.protocol_version:
+        handler_class = type(handler_class.__name__, (handler_class,), {"protocol_version": protocol})
     ServerClass.address_family, addr = _get_best_family(bind, port)
-
-    handler_class.protocol_version = protocol
-    return ServerClass(addr, handler_class)
+    http_server = ServerClass(addr, handler_class)
+    http_server.served_directory = ServedDirectory.of(directory)
+    return http_server
 
 
 class LocalRepositoryStateException(Exception):
@@ -73,7 +160,7 @@ class LocalRepositoryServer(AbstractContextManager):
     def __init__(self, repo_root: Pathish = None, port: int = 0):
         self.repo_root = Path(repo_root or (Path(__file__).parent / "repo1"))
         self._requested_port = port
-        self.http_server: Optional[ThreadingHTTPServer] = None
+        self.http_server: Optional[HTTPServer] = None
         self.serving_thread: Optional[threading.Thread] = None
 
     def __enter__(self) -> 'LocalRepositoryServer':
@@ -90,6 +177,32 @@ class LocalRepositoryServer(AbstractContextManager):
     def __exit__(self, __exc_type, __exc_value, __traceback):
         self.shutdown()
 
+    def set_repo_root(self, repo_root: Pathish):
+        """Change the directory served by this server, which may already be running."""
+        repo_root = Path(repo_root)
+        if not repo_root.is_dir():
+            raise ValueError("repository root path must be a directory")
+        self._serve(repo_root)
+
+    def _serve(self, repo_root: Path):
+        self.repo_root = repo_root
+        http_server = self.http_server
+        if http_server is not None:
+            # handlers read this at the start of each request, so the change applies to the next
+            # request, even on a connection that is already open; listings cached for the
+            # previous directory are discarded along with it
+            http_server.served_directory = ServedDirectory.of(repo_root)
+
+    @contextmanager
+    def scoped_repo(self, repo_root: Pathish) -> Iterator['LocalRepositoryServer']:
+        """Serve a directory for the duration of a context, then restore the previous directory."""
+        previous_repo_root = self.repo_root
+        self.set_repo_root(repo_root)
+        try:
+            yield self
+        finally:
+            self._serve(previous_repo_root)
+
     def pretty_host(self) -> str:
         host = self.http_server.server_name
         url_host = f'[{host}]' if ':' in host else host
@@ -112,7 +225,7 @@ class LocalRepositoryServer(AbstractContextManager):
         http_server = self.http_server
         if http_server is None:
             raise LocalRepositoryStateException("server not created")
-        t = threading.Thread(target=http_server.serve_forever)
+        t = threading.Thread(target=http_server.serve_forever, name="LocalRepositoryServer", daemon=True)
         self.serving_thread = t
         t.start()
         address = (http_server.server_name, http_server.server_port)
@@ -133,9 +246,35 @@ class LocalRepositoryServer(AbstractContextManager):
         thread.join(timeout=join_timeout)
 
 
+_MAIN_FILE = str(Path(__file__).resolve().parent.parent / "__init__.py")
+
+
 def main_file() -> str:
-    this_file = Path(__file__).absolute()
-    return str(this_file.parent.parent / "__init__.py")
+    return _MAIN_FILE
+
+
+def child_pythonpath(pythonpath: Optional[str] = None) -> str:
+    """Return a PYTHONPATH value that lets a child interpreter import shypip from this source tree.
+
+    Running main_file() as a script is not enough on its own, because pip's
+    command registry loads the shypip command classes by module name.
+    """
+    source_root = str(Path(_MAIN_FILE).parent.parent)
+    return os.pathsep.join([source_root, pythonpath] if pythonpath else [source_root])
+
+
+def run_captured(cmd: Sequence[str], text: bool = True, **kwargs: Any) -> subprocess.CompletedProcess:
+    """Run a command, capturing its output as text, or as bytes if text is false.
+
+    Passing close_fds=False (and no preexec_fn, cwd or start_new_session)
+    allows CPython to launch the child with posix_spawn() instead of
+    fork() and exec(). File descriptors are non-inheritable by default,
+    so none leak into the child. Unless another stdin is given, the child's
+    stdin is the null device, so a prompt fails instead of waiting on the
+    terminal.
+    """
+    kwargs.setdefault("stdin", subprocess.DEVNULL)
+    return subprocess.run(cmd, capture_output=True, text=text, close_fds=False, **kwargs)
 
 
 class VirtualEnvException(Exception):
@@ -148,52 +287,154 @@ class VenvCreator(object):
         raise NotImplementedError("abstract")
 
 
-def _system_python() -> str:
-    import shutil
-    python_exe_path = shutil.which("python")
-    return str(Path(python_exe_path).resolve())
+class ModuleVenvCreator(VenvCreator):
 
+    def create(self, venv_dir: Pathish):
+        builder = venv.EnvBuilder(
+            system_site_packages=False,
+            with_pip=True,
+            symlinks=(os.name != 'nt'),
+        )
+        builder.create(str(venv_dir))
 
-class SubprocessVenvCreator(VenvCreator):
 
-    def create(self, venv_dir: Pathish):
-        proc = subprocess.run([
-            _system_python(),
-            "-m", "venv",
-            str(venv_dir)
-        ], capture_output=True, text=True)
-        if proc.returncode != 0:
-            raise VirtualEnvException(f"failed to create virtual environment in {venv_dir}: {proc.stderr}")
+_WINDOWS = platform.system() == "Windows"
 
 
-class ModuleVenvCreator(VenvCreator):
+def _venv_python(venv_dir: Path) -> str:
+    bin_dir = "Scripts" if _WINDOWS else "bin"
+    return str(venv_dir / bin_dir / "python")
 
-    def create(self, venv_dir: Pathish):
-        import venv
-        venv.main([
-            str(venv_dir),
-        ])
+
+def _pip(python: str, command: str, *args: str):
+    cmd = [
+        python, "-m", "pip", "--quiet", "--no-input", command, *args
+    ]
+    proc = run_captured(cmd)
+    if proc.returncode != 0:
+        raise VirtualEnvException(f"pip {command} exit {proc.returncode}: {proc.stderr}")
+
+
+def _link_or_copy(src: str, dst: str) -> str:
+    """Hard-link a file, or copy it if a link is not possible (e.g. across filesystems)."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def clone_tree(src: Pathish, dst: Pathish):
+    """Copy a directory tree, hard-linking files where possible and preserving symlinks."""
+    shutil.copytree(str(src), str(dst), symlinks=True, copy_function=_link_or_copy)
+
+
+@contextmanager
+def _file_lock(lock_file: Path) -> Iterator[None]:
+    """Hold an exclusive lock on a file for the duration of the context, if the platform supports it."""
+    try:
+        import fcntl
+    except ImportError:  # Windows
+        yield
+        return
+    with open(lock_file, "a") as ofile:
+        fcntl.flock(ofile.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(ofile.fileno(), fcntl.LOCK_UN)
+
+
+class VenvTemplateCache(object):
+    """Cache of prebuilt virtual environments that are cloned instead of rebuilt.
+
+    Templates are keyed by interpreter and requirements and persist between
+    test runs, so by default they are kept under the system temp directory,
+    which is usually disk-backed, rather than under temp_root(). A template is built in a staging directory and renamed into
+    place, so a concurrent test process never sees a partial template. Where
+    file locks are available, concurrent processes wait for the one building a
+    template instead of building their own; otherwise, if two processes race,
+    the loser discards its copy.
+    """
+
+    def __init__(self, root: Pathish = None, venv_creator: VenvCreator = None):
+        self._root = root
+        self._venv_creator = venv_creator or ModuleVenvCreator()
+        self._lock = threading.Lock()
+
+    @property
+    def root(self) -> Path:
+        return Path(self._root or (Path(_SYSTEM_TEMPDIR) / "shypip-tests"))
+
+    def template_dir(self, requirements: Sequence[str] = ()) -> Path:
+        key_material = json.dumps([sys.executable, sys.version, list(requirements)])
+        key = hashlib.sha256(key_material.encode("utf-8")).hexdigest()[:16]
+        return self.root / f"venv-template-py{sys.version_info.major}{sys.version_info.minor}-{key}"
+
+    def get(self, requirements: Sequence[str] = ()) -> Path:
+        template_dir = self.template_dir(requirements)
+        with self._lock:
+            if not template_dir.is_dir():
+                self.root.mkdir(parents=True, exist_ok=True)
+                with _file_lock(template_dir.parent / f"{template_dir.name}.lock"):
+                    if not template_dir.is_dir():
+                        self._build(template_dir, requirements)
+        return template_dir
+
+    def _build(self, template_dir: Path, requirements: Sequence[str]):
+        staging_dir = Path(tempfile.mkdtemp(prefix="staging_", dir=self.root))
+        try:
+            venv_dir = staging_dir / "venv"
+            self._venv_creator.create(venv_dir)
+            if requirements:
+                _pip(_venv_python(venv_dir), "install", *requirements)
+            try:
+                os.rename(venv_dir, template_dir)
+            except OSError:
+                if not template_dir.is_dir():
+                    raise
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+_TEMPLATE_CACHE = VenvTemplateCache()
 
 
 class VirtualEnv(AbstractContextManager):
 
-    def __init__(self):
+    def __init__(self, requirements: Sequence[str] = (), template_cache: VenvTemplateCache = None):
         self.tempdir = None
         self.venv_dir = None
-        self._venv_creator = SubprocessVenvCreator()
+        self._python = None
+        self.requirements = tuple(requirements)
+        self._template_cache = template_cache or _TEMPLATE_CACHE
 
     def __enter__(self) -> 'VirtualEnv':
         return self.create()
 
     def create(self) -> 'VirtualEnv':
-        self.tempdir = TemporaryDirectory(prefix="shypiptest_")
+        return self._create_from(self._template_cache.get(self.requirements))
+
+    def clone(self) -> 'VirtualEnv':
+        """Create a new virtual environment that is a copy of this one.
+
+        Files are hard-linked where possible. Environments in this module are
+        only ever run with their own python executable, so the absolute paths in
+        script shebangs and activation scripts do not need to be rewritten.
+        """
+        return VirtualEnv(self.requirements, self._template_cache)._create_from(self.venv_dir)
+
+    def _create_from(self, source_venv_dir: Path) -> 'VirtualEnv':
+        # files are copied rather than hard-linked if this is not on the template's filesystem
+        self.tempdir = TemporaryDirectory(prefix="shypiptest_", dir=temp_root())
         self.venv_dir = Path(self.tempdir.name) / "venv"
         try:
-            self._venv_creator.create(self.venv_dir)
-            self.install("pip~=22.3.1")
+            clone_tree(source_venv_dir, self.venv_dir)
         except:
             self.tempdir.cleanup()
             raise
+        # computed once; each test passes it to every command it runs
+        self._python = _venv_python(self.venv_dir)
         return self
 
     def cleanup(self):
@@ -205,29 +446,74 @@ class VirtualEnv(AbstractContextManager):
         super().__exit__(et, ev, tb)
 
     def python(self) -> str:
-        bin_dir = "Scripts" if platform.system() == "Windows" else "bin"
-        return str(self.venv_dir / bin_dir / "python")
+        return self._python
 
-    def install(self, requirement: str):
-        cmd = [
-            self.python(), "-m", "pip", "--quiet", "--no-input", "install", requirement
-        ]
-        proc = subprocess.run(cmd, capture_output=True, text=True)
-        if proc.returncode != 0:
-            raise VirtualEnvException(f"pip install exit {proc.returncode}: {proc.stderr}")
+    def site_packages(self) -> Path:
+        if _WINDOWS:
+            return self.venv_dir / "Lib" / "site-packages"
+        return self.venv_dir / "lib" / f"python{sys.version_info.major}.{sys.version_info.minor}" / "site-packages"
 
     def list_installed_packages(self) -> List[Tuple[str, str]]:
-        cmd = [
-            self.python(),
-            "-m", "pip", "list"
-        ]
-        proc = subprocess.run(cmd, capture_output=True, text=True)
-        if proc.returncode != 0:
-            raise VirtualEnvException(f"pip list terminated with exit code {proc.returncode}: {proc.stderr}")
-        def to_package_spec(line: str):
-            package_name, version = line.rstrip().split()
-            return package_name, version
-        return [to_package_spec(line) for line in io.StringIO(proc.stdout)][2:]
+        """List installed distributions by reading their metadata in the site-packages directory.
+
+        Virtual environments are cloned from templates built by this interpreter,
+        so the site-packages directory is determined by this interpreter's version.
+        """
+        distributions = importlib.metadata.distributions(path=[str(self.site_packages())])
+        packages = [(d.metadata["Name"], d.version) for d in distributions]
+        return sorted(packages, key=lambda package: package[0].lower())
+
+    def list_installed_packages_fast(self) -> List[Tuple[str, str]]:
+        """List installed distributions by the names of their dist-info directories.
+
+        Metadata files are not read. Names are lowercased with underscores replaced
+        by hyphens, which matches the metadata names of the packages these tests install.
+        """
+        packages = []
+        for dist_info in self.site_packages().glob("*.dist-info"):
+            name, _, version = dist_info.stem.partition("-")
+            packages.append((name.lower().replace("_", "-"), version))
+        return sorted(packages)
+
+
+def ram_backed_dir() -> Optional[str]:
+    """Return a writable RAM-backed directory for temporary files, or None if there is none."""
+    candidate = "/dev/shm"
+    if os.path.isdir(candidate) and os.access(candidate, os.W_OK):
+        return candidate
+    return None
+
+
+def temp_root() -> str:
+    """Return the directory in which tests create temporary files.
+
+    This is the directory named by the SHYPIP_TEST_TMPDIR environment variable
+    if that is set, otherwise a RAM-backed directory if there is one, otherwise
+    the tempfile module's default.
+    """
+    return os.environ.get(ENV_TEST_TMPDIR) or ram_backed_dir() or tempfile.gettempdir()
+
+
+@contextmanager
+def ram_backed_tempdir() -> Iterator[str]:
+    """Make the tempfile module use temp_root() for the duration of the context."""
+    previous = tempfile.tempdir
+    tempfile.tempdir = temp_root()
+    try:
+        yield tempfile.gettempdir()
+    finally:
+        tempfile.tempdir = previous
+
+
+def sha256sum(pathname: Pathish) -> str:
+    """Compute the SHA-256 hex digest of a file without reading the whole file into memory."""
+    with open(pathname, "rb") as ifile:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(ifile, "sha256").hexdigest()
+        h = hashlib.sha256()
+        for chunk in iter(partial(ifile.read, 64 * 1024), b""):
+            h.update(chunk)
+        return h.hexdigest()
 
 
 def maybe_read_text(pathname: Pathish) -> str:
@@ -252,13 +538,11 @@ class Package(NamedTuple):
 
     @staticmethod
     def create(name: str, version: str, file: Path) -> 'Package':
-        h = hashlib.sha256()
-        h.update(file.read_bytes())
-        sha256sum = h.hexdigest()
-        return Package(name, version, file, sha256sum)
+        return Package(name, version, file, sha256sum(file))
 
 
 
+@lru_cache(maxsize=None)
 def get_package(version: str, name: str = "sampleproject") -> Package:
     packages_dir = Path(__file__).absolute().parent.resolve() / "packages"
     filename = f"{name}-{version}-py3-none-any.whl"
@@ -4,37 +4,52 @@ import io
 import os
 import glob
 import datetime
-import hashlib
 import tempfile
 import contextlib
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from typing import Optional
+import unittest
 from unittest import TestCase
 
+# noinspection PyProtectedMember
+from pip._internal.cli.main_parser import parse_command
+
 import shypip.tests
 from shypip import FilePypiStatsCache
+from shypip import ENV_CACHE
 from shypip import ENV_POPULARITY
+from shypip import ENV_PROMPT
+from shypip import MULTIPLE_SOURCES_MESSAGE_PREFIX
 from shypip import Popularity
 from shypip import ShyDownloadCommand
+from shypip import ShyInstallCommand
 from shypip import ShypipOptions
 from shypip import _default_cache_dir
 from shypip.tests import LocalRepositoryServer
 from shypip.tests import environment_context
+from shypip.tests import ram_backed_tempdir
 
+# pip's HTTP cache, shared by the in-process pip commands in this module
+_PIP_CACHE: Optional[TemporaryDirectory] = None
+_SERVER: Optional[LocalRepositoryServer] = None  # repository server shared by the tests in this module
 
-class DownloadCommandTest(TestCase):
 
-    VERBOSE_LOG = False
-    _common_pip_options = [
-        "--require-virtualenv",
-        "--disable-pip-version-check",
-        "--no-color",
-        "--no-input",
-        "--no-cache-dir",
-    ]
+def setUpModule():
+    global _PIP_CACHE, _SERVER
+    tempdir_context = ram_backed_tempdir()
+    tempdir_context.__enter__()
+    unittest.addModuleCleanup(tempdir_context.__exit__, None, None, None)
+    _PIP_CACHE = TemporaryDirectory(prefix="shypiptest_pipcache_")
+    unittest.addModuleCleanup(_PIP_CACHE.cleanup)
+    _SERVER = LocalRepositoryServer().__enter__()
+    unittest.addModuleCleanup(_SERVER.__exit__, None, None, None)
+    _SERVER.start()
+
+
+class DownloadCommandTest(TestCase):
 
     def test_download_find_candidates(self):
-        from pip._internal.cli.main_parser import parse_command
         command = ShyDownloadCommand("download", "Download packages.", isolated=False)
         with TemporaryDirectory(prefix="shypiptest_") as tempdir:
             download_dir = Path(tempdir) / "download"
@@ -43,13 +58,12 @@ class DownloadCommandTest(TestCase):
             repo_dir.mkdir()
             package_130 = shypip.tests.get_package(name="sampleproject", version="1.3.0")
             package_130.publish(repo_dir)
-            with LocalRepositoryServer(repo_root=repo_dir) as server:
-                server.start()
+            with _SERVER.scoped_repo(repo_dir) as server:
                 pip_args = [
                     "--disable-pip-version-check",
                     "--no-color",
                     "--no-input",
-                    "--no-cache-dir",
+                    "--cache-dir", _PIP_CACHE.name,
                     "download",
                     "--dest", str(download_dir),
                     "--progress-bar", "off",
@@ -64,17 +78,54 @@ class DownloadCommandTest(TestCase):
                     with contextlib.redirect_stdout(stdout_buffer):
                         with contextlib.redirect_stderr(stderr_buffer):
                             exit_code = command.main(cmd_args)
-                self.assertEqual(0, exit_code, f"expected exit code:\n\n{stdout_buffer.getvalue()}\n\n{stderr_buffer.getvalue()}")
+                if exit_code != 0:
+                    self.fail(f"expected exit code 0, got {exit_code}:\n\n{stdout_buffer.getvalue()}\n\n{stderr_buffer.getvalue()}")
                 downloaded_files = glob.glob(os.path.join(download_dir, "*.*"))
                 self.assertEqual(1, len(downloaded_files), f"expected one file in download dir:\n\n{stdout_buffer.getvalue()}\n\n{stderr_buffer.getvalue()}")
                 downloaded_file = downloaded_files.pop()
-                with open(downloaded_file, "rb") as ifile:
-                    h = hashlib.sha256()
-                    h.update(ifile.read())
-                    downloaded_hash = h.hexdigest()
+                downloaded_hash = shypip.tests.sha256sum(downloaded_file)
                 self.assertEqual(package_130.sha256sum, downloaded_hash, "expect hash match of downloaded to private package")
 
 
+class InstallCommandTest(TestCase):
+
+    def test_install_publichigher_popular_noinput(self):
+        command = ShyInstallCommand("install", "Install packages.", isolated=False)
+        with TemporaryDirectory(prefix="shypiptest_") as tempdir:
+            repo_dir = Path(tempdir) / "repo"
+            repo_dir.mkdir()
+            shypip.tests.get_package(name="sampleproject", version="1.3.0").publish(repo_dir)
+            stats_cache_dir = Path(tempdir) / "stats-cache"
+            cache = FilePypiStatsCache(ShypipOptions(cache_dir=str(stats_cache_dir)))
+            cache.write_popularity("sampleproject", Popularity(100, 200, 300))
+            with _SERVER.scoped_repo(repo_dir) as server:
+                pip_args = [
+                    "--disable-pip-version-check",
+                    "--no-color",
+                    "--no-input",
+                    "--cache-dir", _PIP_CACHE.name,
+                    "install",
+                    "--dry-run",
+                    "--progress-bar", "off",
+                    "--no-deps",
+                    "sampleproject~=1.3.0",
+                    "--extra-index-url", server.url(host="localhost"),
+                ]
+                cmd_name, cmd_args = parse_command(pip_args)
+                stdout_buffer = io.StringIO()
+                stderr_buffer = io.StringIO()
+                env = {
+                    ENV_POPULARITY: "50",
+                    ENV_PROMPT: "yes",
+                    ENV_CACHE: str(stats_cache_dir),
+                }
+                with environment_context(env):
+                    with contextlib.redirect_stdout(stdout_buffer):
+                        with contextlib.redirect_stderr(stderr_buffer):
+                            exit_code = command.main(cmd_args)
+                if exit_code != 1:
+                    self.fail(f"expected exit code 1, got {exit_code}:\n\n{stdout_buffer.getvalue()}\n\n{stderr_buffer.getvalue()}")
+                self.assertIn(MULTIPLE_SOURCES_MESSAGE_PREFIX, stderr_buffer.getvalue())
 
 
 class FilePypiStatsCacheTest(TestCase):
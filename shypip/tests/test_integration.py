@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
 import os
+import shutil
 import subprocess
 import urllib.parse
 from pathlib import Path
-from typing import List, Dict, NamedTuple, Tuple
+from tempfile import TemporaryDirectory
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, NamedTuple, Tuple, Optional, Mapping
+import unittest
 from unittest import TestCase
 
 from shypip import ENV_CACHE
@@ -18,12 +23,42 @@ from shypip import ShypipOptions
 from shypip.tests import LocalRepositoryServer
 from shypip.tests import VirtualEnv
 from shypip.tests import main_file
+from shypip.tests import child_pythonpath
 from shypip.tests import Package
 from shypip.tests import get_package
 from shypip.tests import InstallReport
 from shypip.tests import maybe_read_text
+from shypip.tests import run_captured
+from shypip.tests import ram_backed_tempdir
 
 _KNOWN_PUBLIC_131_SHA256SUM = "75bb5bb4e74a1b77dc0cff25ebbacb54fe1318aaf99a86a036cefc86ed885ced"
+ENV_RUN_SUBPROCESS_TESTS = "SHYPIP_RUN_SUBPROCESS_TESTS"
+_PIP_REQUIREMENT = "pip~=22.3.1"  # shypip depends on internals of this pip version
+# sampleproject's only dependency is installed up front, so pip finds it satisfied instead of looking it up on the indexes
+_TEMPLATE_REQUIREMENTS = (_PIP_REQUIREMENT, "peppercorn")
+_TEMPLATE_ENV: Optional[VirtualEnv] = None  # cloned by each MainTest test
+_SESSION_CACHE_DIR: Optional[Path] = None  # pip cache shared by the tests in this module
+_SERVER: Optional[LocalRepositoryServer] = None  # repository server shared by the tests in this module
+
+
+def setUpModule():
+    global _SESSION_CACHE_DIR, _SERVER, _TEMPLATE_ENV
+    tempdir_context = ram_backed_tempdir()
+    tempdir_context.__enter__()
+    unittest.addModuleCleanup(tempdir_context.__exit__, None, None, None)
+    session_cache = TemporaryDirectory(prefix="shypiptest_pipcache_")
+    unittest.addModuleCleanup(session_cache.cleanup)
+    _SESSION_CACHE_DIR = Path(session_cache.name)
+    virtual_env = VirtualEnv(requirements=_TEMPLATE_REQUIREMENTS)
+    unittest.addModuleCleanup(virtual_env.cleanup)  # a no-op unless creation succeeds
+    # creating the virtual environment and starting the server do not depend on each other
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        created = executor.submit(virtual_env.create)
+        _SERVER = LocalRepositoryServer().__enter__()
+        unittest.addModuleCleanup(_SERVER.__exit__, None, None, None)
+        _SERVER.start()
+        created.result()
+    _TEMPLATE_ENV = virtual_env
 
 
 class PackagePopularity(NamedTuple):
@@ -45,6 +80,17 @@ class TestSetup(NamedTuple):
         return self.private_repo_packages[0]
 
 
+def _publichigher_setup(popularity_threshold: str, prompt_answer: str) -> TestSetup:
+    """Set up a private repository whose only package is older than the one on the public index."""
+    return TestSetup(
+        private_repo_packages=(get_package("1.3.0"),),
+        public_package_popularities=(PackagePopularity("sampleproject", Popularity(100, 200, 300)),),
+        dependency_declaration="sampleproject~=1.3.0",
+        popularity_threshold=popularity_threshold,
+        prompt_answer=prompt_answer,
+    )
+
+
 class TestResult(NamedTuple):
 
     proc: subprocess.CompletedProcess
@@ -52,8 +98,18 @@ class TestResult(NamedTuple):
     packages_installed_after: Tuple[Tuple[str, str], ...]
     install_report: InstallReport
 
+    @property
+    def stdout(self) -> str:
+        return self.proc.stdout.decode("utf-8", "replace")
+
+    @property
+    def stderr(self) -> str:
+        return self.proc.stderr.decode("utf-8", "replace")
+
     def assert_exit_code(self, test_case: TestCase, expected: int):
-        test_case.assertEqual(expected, self.proc.returncode, f"unexpected exit code from shypip:\n\n{self.proc.stdout}\n\n{self.proc.stderr}")
+        # format the output only on failure; pip output can be long
+        if self.proc.returncode != expected:
+            test_case.fail(f"unexpected exit code from shypip: {expected} != {self.proc.returncode}:\n\n{self.stdout}\n\n{self.stderr}")
 
     def assert_nothing_installed(self, test_case: TestCase):
         test_case.assertSetEqual(set(self.packages_installed_before), set(self.packages_installed_after))
@@ -62,63 +118,74 @@ class TestResult(NamedTuple):
 class MainTest(TestCase):
 
     VERBOSE_LOG = False
-    _common_pip_options = [
+    _COMMON_PIP_OPTIONS: Tuple[str, ...] = (
         "--require-virtualenv",
         "--disable-pip-version-check",
-        "--no-cache-dir",
         "--no-color",
-    ]
+    )
+    # written once per class, then copied into each test's stats cache
+    _CANNED_POPULARITIES: Tuple[PackagePopularity, ...] = (
+        PackagePopularity("sampleproject", Popularity(100, 200, 300)),
+    )
+
+    @classmethod
+    def setUpClass(cls):
+        cls.template_env = _TEMPLATE_ENV
+        cls.server = _SERVER
+        cls.repo_url = cls.server.url(host="localhost")
+        # everything but the interpreter, which differs per test, is fixed for the class
+        cls._install_args = (
+            main_file(),
+            *cls._COMMON_PIP_OPTIONS,
+            "install",
+            "--progress-bar", "off",
+            "--extra-index-url", cls.repo_url,
+        )
+        cls._BASE_ENV = dict(os.environ)
+        # every test starts from a clone of the template, so what is installed beforehand never varies
+        cls._BASELINE_PACKAGES = tuple(cls.template_env.list_installed_packages_fast())
+        canned_stats = TemporaryDirectory(prefix="shypiptest_stats_")
+        cls.addClassCleanup(canned_stats.cleanup)
+        cls._canned_stats_dir = Path(canned_stats.name)
+        canned_cache = FilePypiStatsCache(ShypipOptions(cache_dir=str(cls._canned_stats_dir)))
+        for package_name, popularity in cls._CANNED_POPULARITIES:
+            canned_cache.write_popularity(package_name, popularity)
 
     def setUp(self):
-        self.virtual_env = VirtualEnv().create()
+        self.virtual_env = self.template_env.clone()
+        # cleanups run even if the rest of setUp fails
+        self.addCleanup(self.virtual_env.cleanup)
         tempdir = Path(self.virtual_env.tempdir.name)
         self.log_file = tempdir / "shypip.log"
         self.report_file = tempdir / "report.json"
         self.stats_cache_dir = tempdir / "stats-cache"
-
-    def tearDown(self):
-        if hasattr(self, "virtual_env"):
-            self.virtual_env.cleanup()
+        # copied, not hard-linked: the cache rewrites popularity files in place
+        shutil.copytree(self._canned_stats_dir, self.stats_cache_dir)
+        self._default_env_vars = self._default_env()
 
     def _default_env(self) -> Dict[str, str]:
         return {
             ENV_LOG_FILE: str(self.log_file),
             ENV_PROMPT: "no",
             ENV_CACHE: str(self.stats_cache_dir),
+            "PIP_CACHE_DIR": str(_SESSION_CACHE_DIR),
+            "PYTHONPATH": child_pythonpath(self._BASE_ENV.get("PYTHONPATH")),
         }
 
-    def _env(self, more_env: Dict[str, str] = None) -> Dict[str, str]:
-        env = dict(os.environ)
-        env.update(self._default_env())
-        if more_env:
-            env.update(more_env)
-        return env
+    def _env(self, more_env: Dict[str, str] = None) -> Mapping[str, str]:
+        return ChainMap(more_env or {}, self._default_env_vars, self._BASE_ENV)
 
-    def _shypip_cmd(self, setup: TestSetup, server: LocalRepositoryServer, more_install_args: List[str] = None) -> List[str]:
-        cmd = [
+    def _shypip_cmd(self, setup: TestSetup, more_install_args: List[str] = None) -> List[str]:
+        return [
             self.virtual_env.python(),
-            str(main_file()),
-        ]
-        cmd += self._common_pip_options
-        cmd += [
-            "install",
-            "--progress-bar", "off",
-            "--extra-index-url", server.url(host="localhost"),
+            *self._install_args,
             "--report", str(self.report_file),
             setup.dependency_declaration,
+            *(more_install_args or ()),
         ]
-        if more_install_args:
-            cmd += more_install_args
-        return cmd
 
     def test_install_publichigher_popular_promptaccept(self):
-        setup = TestSetup(
-            private_repo_packages=(get_package("1.3.0"),),
-            public_package_popularities=(PackagePopularity("sampleproject", Popularity(100, 200, 300)),),
-            dependency_declaration="sampleproject~=1.3.0",
-            popularity_threshold="50",
-            prompt_answer="yes",
-        )
+        setup = _publichigher_setup(popularity_threshold="50", prompt_answer="yes")
         passed = False
         result = self._run_shypip(setup)
         try:
@@ -131,47 +198,30 @@ class MainTest(TestCase):
         finally:
             self._print_log(not passed)
 
+    @unittest.skipUnless(os.getenv(ENV_RUN_SUBPROCESS_TESTS) == "1",
+                         f"covered in-process by InstallCommandTest; set {ENV_RUN_SUBPROCESS_TESTS}=1 to run")
     def test_install_publichigher_popular_noinput(self):
         """User specifies --no-input."""
-        setup = TestSetup(
-            private_repo_packages=(get_package("1.3.0"),),
-            public_package_popularities=(PackagePopularity("sampleproject", Popularity(100, 200, 300)),),
-            dependency_declaration="sampleproject~=1.3.0",
-            popularity_threshold="50",
-            prompt_answer="yes",
-        )
+        setup = _publichigher_setup(popularity_threshold="50", prompt_answer="yes")
         passed = False
         result = self._run_shypip(setup, ["--no-input"])
         try:
             result.assert_exit_code(self, 1)
             result.assert_nothing_installed(self)
-            self.assertIn(MULTIPLE_SOURCES_MESSAGE_PREFIX, result.proc.stderr)
+            self.assertIn(MULTIPLE_SOURCES_MESSAGE_PREFIX.encode(), result.proc.stderr)
             passed = True
         finally:
             self._print_log(not passed)
 
     def test_install_publichigher_popularitydisabled(self):
-        setup = TestSetup(
-            private_repo_packages=(get_package("1.3.0"),),
-            public_package_popularities=(PackagePopularity("sampleproject", Popularity(100, 200, 300)),),
-            dependency_declaration="sampleproject~=1.3.0",
-            popularity_threshold="",
-            prompt_answer="yes",
-        )
+        setup = _publichigher_setup(popularity_threshold="", prompt_answer="yes")
         result = self._run_shypip(setup)
         self._assert_private_package_installed(setup, result)
-        with open(self.log_file, "r") as ifile:
-            log_lines = [line.rstrip() for line in ifile]
-            self.assertIn("resolution ambiguous and popularity check disabled", log_lines)
+        log_lines = self.log_file.read_text().splitlines()
+        self.assertIn("resolution ambiguous and popularity check disabled", log_lines)
 
     def test_install_publichigher_popular_promptreject(self):
-        setup = TestSetup(
-            private_repo_packages=(get_package("1.3.0"),),
-            public_package_popularities=(PackagePopularity("sampleproject", Popularity(100, 200, 300)),),
-            dependency_declaration="sampleproject~=1.3.0",
-            popularity_threshold="50",
-            prompt_answer="no",
-        )
+        setup = _publichigher_setup(popularity_threshold="50", prompt_answer="no")
         result = self._run_shypip(setup)
         self._assert_private_package_installed(setup, result)
 
@@ -200,13 +250,7 @@ class MainTest(TestCase):
             self._print_log(not passed)
 
     def test_install_publichigher_unpopular(self):
-        setup = TestSetup(
-            private_repo_packages=(get_package("1.3.0"),),
-            public_package_popularities=(PackagePopularity("sampleproject", Popularity(100, 200, 300)),),
-            dependency_declaration="sampleproject~=1.3.0",
-            popularity_threshold="9999999",
-            prompt_answer="no",
-        )
+        setup = _publichigher_setup(popularity_threshold="9999999", prompt_answer="no")
         result = self._run_shypip(setup)
         self._assert_private_package_installed(setup, result)
 
@@ -222,26 +266,26 @@ class MainTest(TestCase):
         self._assert_private_package_installed(setup, result)
 
     def _run_shypip(self, setup: TestSetup, more_install_args: List[str] = None) -> TestResult:
-        packages_installed = self.virtual_env.list_installed_packages()
         repo_dir = Path(self.virtual_env.tempdir.name) / "repo"
         repo_dir.mkdir()
         for package in setup.private_repo_packages:
             package.publish(repo_dir)
         for package_name, popularity in setup.public_package_popularities:
-            self._prepare_cache_dir(package_name, popularity)
-        with LocalRepositoryServer(repo_root=repo_dir) as server:
-            server.start()
-            cmd =  self._shypip_cmd(setup, server, more_install_args)
+            if (package_name, popularity) not in self._CANNED_POPULARITIES:
+                self._prepare_cache_dir(package_name, popularity)
+        with self.server.scoped_repo(repo_dir):
+            cmd = self._shypip_cmd(setup, more_install_args)
             env = self._env({
                 ENV_POPULARITY: setup.popularity_threshold,  # disable popularity check
                 ENV_PROMPT: setup.prompt_answer,
             })
-            proc = subprocess.run(cmd, capture_output=True, text=True, env=env)
-            actual_packages_installed = self.virtual_env.list_installed_packages()
+            # output stays as bytes; TestResult decodes it only when asked
+            proc = run_captured(cmd, text=False, env=dict(env))
+            actual_packages_installed = self.virtual_env.list_installed_packages_fast()
             report_text = maybe_read_text(self.report_file)
             return TestResult(
                 proc=proc,
-                packages_installed_before=tuple(packages_installed),
+                packages_installed_before=self._BASELINE_PACKAGES,
                 packages_installed_after=tuple(actual_packages_installed),
                 install_report=InstallReport(report_text),
             )
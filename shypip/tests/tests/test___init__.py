@@ -2,17 +2,160 @@
 
 """Tests of shypip.tests.__init__.py"""
 
+import os
+import sys
+import time
+import subprocess
+import threading
+import unittest.mock
+import http.client
 import urllib.request
+from pathlib import Path
+from tempfile import TemporaryDirectory
 from shypip.tests import LocalRepositoryServer
+from shypip.tests import clone_tree
+from shypip.tests import run_captured
+from shypip.tests import VenvCreator
+from shypip.tests import VenvTemplateCache
+from shypip.tests import VirtualEnv
 from unittest import TestCase
 
 
 class LocalRepositoryServerTest(TestCase):
 
+    _README_HEAD_SIZE = 128  # the README's first line identifies it; the rest need not be read
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = LocalRepositoryServer().__enter__()
+        cls.addClassCleanup(cls.server.__exit__, None, None, None)
+        cls.server.start()
+
     def test_start(self):
-        with LocalRepositoryServer() as server:
-            server.start()
-            readme_url = server.url("/README.txt")
-            with urllib.request.urlopen(readme_url) as rsp:
-                content = rsp.read().decode('utf-8')
-                self.assertIn("Local repository for testing", content.strip())
+        readme_url = self.server.url("/README.txt")
+        with urllib.request.urlopen(readme_url) as rsp:
+            content = rsp.read(self._README_HEAD_SIZE).decode('utf-8')
+            self.assertIn("Local repository for testing", content.strip())
+
+    def test_keep_alive(self):
+        port = self.server.http_server.server_port
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        try:
+            # a file, a directory listing and the redirect to a directory's canonical path
+            for path in ["/README.txt", "/sampleproject/", "/sampleproject"]:
+                connection.request("GET", path)
+                rsp = connection.getresponse()
+                rsp.read()
+                self.assertEqual(11, rsp.version, "expect HTTP/1.1")
+                self.assertFalse(rsp.will_close, f"expect connection kept alive after {path}")
+        finally:
+            connection.close()
+
+    def test_scoped_repo(self):
+        server = self.server
+        with TemporaryDirectory() as tempdir:
+            Path(tempdir, "other.txt").write_text("other repository")
+            with server.scoped_repo(tempdir):
+                with urllib.request.urlopen(server.url("/other.txt")) as rsp:
+                    self.assertEqual("other repository", rsp.read().decode('utf-8'))
+            with urllib.request.urlopen(server.url("/README.txt")) as rsp:
+                self.assertIn("Local repository for testing", rsp.read(self._README_HEAD_SIZE).decode('utf-8'))
+
+    def test_scoped_repo_keep_alive(self):
+        server = self.server
+        connection = http.client.HTTPConnection("127.0.0.1", server.http_server.server_port, timeout=10)
+        try:
+            connection.request("GET", "/README.txt")
+            connection.getresponse().read()
+            with TemporaryDirectory() as tempdir:
+                Path(tempdir, "other.txt").write_text("other repository")
+                with server.scoped_repo(tempdir):
+                    connection.request("GET", "/other.txt")
+                    rsp = connection.getresponse()
+                    self.assertEqual("other repository", rsp.read().decode('utf-8'))
+                    self.assertFalse(rsp.will_close, "expect the same connection throughout")
+        finally:
+            connection.close()
+
+    def test_directory_listing_cached(self):
+        server = self.server
+        with TemporaryDirectory() as tempdir:
+            Path(tempdir, "sampleproject").mkdir()
+            Path(tempdir, "sampleproject", "a.whl").write_text("a")
+            with server.scoped_repo(tempdir):
+                listing_url = server.url("/sampleproject/")
+                with urllib.request.urlopen(listing_url) as rsp:
+                    first = rsp.read().decode('utf-8')
+                self.assertIn("a.whl", first)
+                Path(tempdir, "sampleproject", "b.whl").write_text("b")
+                with urllib.request.urlopen(listing_url) as rsp:
+                    self.assertEqual(first, rsp.read().decode('utf-8'))
+            with server.scoped_repo(tempdir):
+                with urllib.request.urlopen(listing_url) as rsp:
+                    self.assertIn("b.whl", rsp.read().decode('utf-8'))
+
+
+class CloneTreeTest(TestCase):
+
+    def test_clone_tree(self):
+        with TemporaryDirectory() as tempdir:
+            src = Path(tempdir) / "src"
+            (src / "sub").mkdir(parents=True)
+            (src / "sub" / "a.txt").write_text("a")
+            os.symlink("sub/a.txt", src / "link")
+            dst = Path(tempdir) / "dst"
+            clone_tree(src, dst)
+            self.assertEqual("a", (dst / "sub" / "a.txt").read_text())
+            self.assertTrue((dst / "link").is_symlink())
+            self.assertEqual("sub/a.txt", os.readlink(dst / "link"))
+            self.assertTrue((dst / "sub" / "a.txt").samefile(src / "sub" / "a.txt"), "expect hard link")
+
+
+class SlowVenvCreator(VenvCreator):
+
+    def __init__(self):
+        self.created = []
+
+    def create(self, venv_dir):
+        time.sleep(0.2)
+        os.makedirs(venv_dir)
+        self.created.append(venv_dir)
+
+
+class VenvTemplateCacheTest(TestCase):
+
+    def test_get_concurrent(self):
+        with TemporaryDirectory() as tempdir:
+            creator = SlowVenvCreator()
+            # separate instances do not share a thread lock, as in separate processes
+            caches = [VenvTemplateCache(root=tempdir, venv_creator=creator) for _ in range(2)]
+            results = []
+            threads = [threading.Thread(target=lambda c=c: results.append(c.get())) for c in caches]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(1, len(creator.created), "expect one build")
+            self.assertEqual(1, len(set(results)))
+            self.assertTrue(results[0].is_dir())
+
+
+class VirtualEnvTest(TestCase):
+
+    def test_list_installed_packages_fast(self):
+        with VirtualEnv() as virtual_env:
+            expected = [(name.lower(), version) for name, version in virtual_env.list_installed_packages()]
+            self.assertNotEqual([], expected)
+            self.assertListEqual(expected, virtual_env.list_installed_packages_fast())
+
+
+class RunCapturedTest(TestCase):
+
+    # noinspection PyUnresolvedReferences,PyProtectedMember
+    @unittest.skipUnless(getattr(subprocess, "_USE_POSIX_SPAWN", False), "posix_spawn not used on this platform")
+    def test_uses_posix_spawn(self):
+        with unittest.mock.patch("os.posix_spawn", wraps=os.posix_spawn) as posix_spawn:
+            proc = run_captured([sys.executable, "-c", "print('hello')"])
+        self.assertEqual(0, proc.returncode)
+        self.assertEqual("hello", proc.stdout.strip())
+        posix_spawn.assert_called_once()